@@ -1,5 +1,7 @@
-import json
+import orjson
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 
@@ -8,8 +10,8 @@ def parse_graph_json(json_path):
     """
     Parse the graph JSON and return nodes and relationships.
     """
-    with open(json_path, 'r') as f:
-        data = json.load(f)
+    with open(json_path, 'rb') as f:
+        data = orjson.loads(f.read())
     nodes_by_id = {node['id']: node for node in data['nodes']}
     relationships = data['relationships']
     return nodes_by_id, relationships
@@ -19,21 +21,15 @@ def extract_coordinates(nodes_by_id):
     """
     Extract coordinates for all nodes with latitude and longitude.
     """
-    coords = {}
-    for node_id, node in nodes_by_id.items():
-        props = node['properties']
-        lat = props.get('latitude')
-        lon = props.get('longitude')
-        try:
-            if lat is not None and lon is not None:
-                lat_f = float(lat)
-                lon_f = float(lon)
-                # Only plot if in valid range
-                if -90 <= lat_f <= 90 and -180 <= lon_f <= 180:
-                    coords[node_id] = (lat_f, lon_f)
-        except Exception:
-            continue
-    return coords
+    ids = np.fromiter(nodes_by_id.keys(), dtype=np.int64, count=len(nodes_by_id))
+    props = [node['properties'] for node in nodes_by_id.values()]
+    # Missing coordinates become NaN and fail the range mask below
+    lats = np.array([p.get('latitude') for p in props], dtype=np.float64)
+    lons = np.array([p.get('longitude') for p in props], dtype=np.float64)
+
+    # Only plot if in valid range
+    mask = (lats >= -90) & (lats <= 90) & (lons >= -180) & (lons <= 180)
+    return dict(zip(ids[mask].tolist(), zip(lats[mask].tolist(), lons[mask].tolist())))
 
 
 def plot_graph_on_world(json_path, output_path=None):
@@ -51,23 +47,26 @@ def plot_graph_on_world(json_path, output_path=None):
     ax.add_feature(cfeature.LAND, facecolor='lightgray')
     ax.add_feature(cfeature.OCEAN, facecolor='lightblue')
 
-    # Plot only nodes with coordinates
-    for node_id, (lat, lon) in coords.items():
-        # Check if it's the last node in the relationships
-        is_last_node = not any(rel['start'] == node_id for rel in relationships)
-        if is_last_node:
-            ax.plot(lon, lat, 'go', markersize=8, transform=ccrs.PlateCarree(), label='Last Node' if 'Last Node' not in ax.get_legend_handles_labels()[1] else "")
-        else:
-            ax.plot(lon, lat, 'ro', markersize=6, transform=ccrs.PlateCarree())
+    # Plot only nodes with coordinates, last nodes (no outgoing hop) in green
+    starts = {rel['start'] for rel in relationships}
+    node_ids = list(coords)
+    lats = np.array([coords[node_id][0] for node_id in node_ids])
+    lons = np.array([coords[node_id][1] for node_id in node_ids])
+    last_mask = np.array([node_id not in starts for node_id in node_ids], dtype=bool)
+    ax.scatter(
+        lons, lats,
+        c=np.where(last_mask, 'g', 'r'),
+        s=np.where(last_mask, 64, 36),
+        transform=ccrs.PlateCarree()
+    )
 
     # Plot only relationships where both nodes have coordinates
-    for rel in relationships:
-        start = rel['start']
-        end = rel['end']
-        if start in coords and end in coords:
-            lat1, lon1 = coords[start]
-            lat2, lon2 = coords[end]
-            ax.plot([lon1, lon2], [lat1, lat2], 'b-', linewidth=2, transform=ccrs.PlateCarree())
+    segments = [
+        [(coords[rel['start']][1], coords[rel['start']][0]), (coords[rel['end']][1], coords[rel['end']][0])]
+        for rel in relationships
+        if rel['start'] in coords and rel['end'] in coords
+    ]
+    ax.add_collection(LineCollection(segments, colors='blue', linewidths=2, transform=ccrs.PlateCarree()))
 
     plt.title('Traceroute Graph on World Map')
     if output_path:
@@ -4,7 +4,7 @@ import argparse
 
 from src.dns_resolver import DNSResolver
 from src.traceroute import TracerouteRunner
-from src.geolocation import GeolocationService
+from src.geolocation import GeolocationService, MAX_BATCH_SIZE
 from src.graph_db import GraphDatabase
 from src.utils import parse_config_yaml
 
@@ -22,20 +22,118 @@ logger = logging.getLogger(__name__)
 
 
 class NetworkPathAnalyzer:    
-    def __init__(self, config):
+    def __init__(self, config, max_concurrency = 8, queue_size = 64, geo_batch_window = 0.05):
         self.config = config
+        # Number of traceroute workers in the pipeline, and of traceroutes in flight
+        self.max_concurrency = max_concurrency
+        # Bound on items waiting between pipeline stages (backpressure)
+        self.queue_size = queue_size
+        # How long the geolocation stage waits to fill a batch, in seconds
+        self.geo_batch_window = geo_batch_window
         self.dns_resolver = DNSResolver()
-        self.traceroute_runner = TracerouteRunner()
+        self.traceroute_runner = TracerouteRunner(max_concurrent=max_concurrency)
         self.geolocation_service = GeolocationService()
         self.graph_db = GraphDatabase(config['neo4j'])
     
     async def analyze_domains(self, domains):
-        """Analyze network paths for a list of domains."""
+        """
+        Analyze network paths for a list of domains.
+        Resolved domains flow through a traceroute -> geolocation -> database
+        pipeline connected by bounded queues, so each stage overlaps with the others.
+        """
         logger.info(f"Starting analysis for {len(domains)} domains")
         
-        for domain in domains:
+        # Resolve every domain up front, in parallel
+        ip_map = await self.dns_resolver.resolve_multiple(domains)
+        for domain, target_ip in ip_map.items():
+            if not target_ip:
+                logger.warning(f"Could not resolve {domain}")
+        
+        dns_q = asyncio.Queue(maxsize=self.queue_size)
+        geo_q = asyncio.Queue(maxsize=self.queue_size)
+        db_q = asyncio.Queue(maxsize=self.queue_size)
+        
+        # One Neo4j session for the whole batch
+        async with await self.graph_db.session() as session:
+            async with asyncio.TaskGroup() as tg:
+                tracers = [
+                    tg.create_task(self._traceroute_worker(dns_q, geo_q))
+                    for _ in range(self.max_concurrency)
+                ]
+                tg.create_task(self._geo_worker(geo_q, db_q))
+                tg.create_task(self._db_worker(db_q, session))
+                
+                for domain, target_ip in ip_map.items():
+                    if target_ip:
+                        await dns_q.put((domain, target_ip))
+                
+                # None tells a stage there is no more input
+                for _ in tracers:
+                    await dns_q.put(None)
+                await asyncio.gather(*tracers)
+                await geo_q.put(None)
+    
+    async def _traceroute_worker(self, dns_q, geo_q):
+        """Pipeline stage: (domain, target_ip) -> (domain, target_ip, hops)."""
+        while (item := await dns_q.get()) is not None:
+            domain, target_ip = item
+            try:
+                hops = await self._trace(domain, target_ip)
+            except Exception as e:
+                logger.error(f"Failed to analyze {domain}: {e}")
+                continue
+            if hops:
+                await geo_q.put((domain, target_ip, hops))
+    
+    async def _geo_worker(self, geo_q, db_q):
+        """
+        Pipeline stage: (domain, target_ip, hops) -> (domain, target_ip, enriched_hops).
+        Paths are micro-batched (up to MAX_BATCH_SIZE IPs or geo_batch_window seconds)
+        so several domains share one geolocation batch request.
+        """
+        loop = asyncio.get_running_loop()
+        done = False
+        while not done:
+            item = await geo_q.get()
+            if item is None:
+                break
+            
+            batch = [item]
+            # Unique hop IPs across the batch, in path order
+            unique_ips = dict.fromkeys(item[2])
+            deadline = loop.time() + self.geo_batch_window
+            while len(unique_ips) < MAX_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(geo_q.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+                unique_ips.update(dict.fromkeys(item[2]))
+            
             try:
-                await self.analyze_single_domain(domain)
+                geo_map = await self.geolocation_service.get_locations_batch(list(unique_ips))
+            except Exception as e:
+                logger.error(f"Geolocation failed for {len(batch)} domains: {e}")
+                geo_map = {}
+            
+            for domain, target_ip, hops in batch:
+                await db_q.put((domain, target_ip, self._enrich_hops(hops, geo_map)))
+        
+        await db_q.put(None)
+    
+    async def _db_worker(self, db_q, session):
+        """Pipeline stage: store (domain, target_ip, enriched_hops) in the graph database."""
+        while (item := await db_q.get()) is not None:
+            domain, target_ip, enriched_hops = item
+            try:
+                await self.graph_db.store_network_path(domain, target_ip, enriched_hops, session=session)
+                logger.info(f"Stored network path for {domain} in graph database")
             except Exception as e:
                 logger.error(f"Failed to analyze {domain}: {e}")
     
@@ -49,29 +147,44 @@ class NetworkPathAnalyzer:
             logger.warning(f"Could not resolve {domain}")
             return
         
-        logger.info(f"Resolved {domain} to {target_ip}")
-        
+        await self._analyze_resolved(domain, target_ip)
+    
+    async def _analyze_resolved(self, domain, target_ip):
+        """Analyze network path for a domain already resolved to target_ip."""
         # Step 2: Traceroute
-        hops = await self.traceroute_runner.run_traceroute(target_ip)
+        hops = await self._trace(domain, target_ip)
         if not hops:
-            logger.warning(f"No traceroute hops found for {target_ip}")
             return
         
-        logger.info(f"Found {len(hops)} hops for {domain}")
-        
-        # Step 3: Geolocation lookup for all hops
-        enriched_hops = []
-        for hop in hops:
-            geo_data = await self.geolocation_service.get_location(hop)
-            enriched_hops.append({
-                'ip': hop,
-                'geo_data': geo_data
-            })
+        # Step 3: Geolocation lookup for each distinct hop
+        unique_hops = list(dict.fromkeys(hops))
+        geo_map = await self.geolocation_service.get_locations_batch(unique_hops)
+        enriched_hops = self._enrich_hops(hops, geo_map)
         
         # Step 4: Store in graph database
         await self.graph_db.store_network_path(domain, target_ip, enriched_hops)
         logger.info(f"Stored network path for {domain} in graph database")
     
+    async def _trace(self, domain, target_ip):
+        """Run traceroute for a resolved domain and return its hop IPs."""
+        logger.info(f"Resolved {domain} to {target_ip}")
+        
+        hops = await self.traceroute_runner.run_traceroute(target_ip)
+        if not hops:
+            logger.warning(f"No traceroute hops found for {target_ip}")
+            return []
+        
+        logger.info(f"Found {len(hops)} hops for {domain}")
+        return hops
+    
+    @staticmethod
+    def _enrich_hops(hops, geo_map):
+        """Pair each hop IP with its geolocation data, keeping the original path order."""
+        return [
+            {'ip': hop, 'geo_data': geo_map.get(hop)}
+            for hop in hops
+        ]
+    
     async def close(self):
         """Cleanup resources."""
         await self.graph_db.close()
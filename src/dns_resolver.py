@@ -1,6 +1,10 @@
-import socket
 import asyncio
+import ipaddress
 import logging
+import socket
+import time
+
+import aiodns
 
 logger = logging.getLogger(__name__)
 
@@ -8,21 +12,65 @@ logger = logging.getLogger(__name__)
 class DNSResolver:
     """Handles DNS resolution for domains."""
     
-    def __init__(self):
-        pass
+    def __init__(self, timeout = 2, tries = 2, ttl = 300):
+        self.timeout = timeout
+        self.tries = tries
+        # Fallback cache lifetime when the response carries no TTL
+        self.ttl = ttl
+        self._resolver = None
+        # domain -> (expiry on the monotonic clock, ip)
+        self._cache: dict[str, tuple[float, str]] = {}
+        # (domain, rrtype) -> in-flight lookup, shared by duplicate callers
+        self._pending: dict[tuple[str, str], asyncio.Future] = {}
+    
+    def _ensure_resolver(self):
+        """Ensure the c-ares resolver is created (needs a running loop)."""
+        if self._resolver is None:
+            self._resolver = aiodns.DNSResolver(timeout=self.timeout, tries=self.tries)
     
     async def resolve(self, domain):
+        # IP literals need no lookup
+        try:
+            return str(ipaddress.IPv4Address(domain))
+        except ValueError:
+            pass
+        
+        cached = self._cache.get(domain)
+        if cached is not None:
+            expires_at, ip = cached
+            if time.monotonic() < expires_at:
+                return ip
+            del self._cache[domain]
+        
+        key = (domain, 'A')
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._query(domain))
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+        # Shield so a cancelled caller doesn't cancel the lookup for the others
+        return await asyncio.shield(future)
+    
+    async def _query(self, domain):
+        self._ensure_resolver()
         try:
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                None, 
-                socket.gethostbyname, 
-                domain
-            )
-            logger.debug(f"Resolved {domain} to {result}")
+            try:
+                records = await self._resolver.query(domain, 'A')
+                result = records[0].host
+                ttl = min((r.ttl for r in records if getattr(r, 'ttl', None) is not None), default=self.ttl)
+            except aiodns.error.DNSError:
+                # gethostbyname also consults /etc/hosts and search domains,
+                # but its answer carries no TTL
+                host = await self._resolver.gethostbyname(domain, socket.AF_INET)
+                result = host.addresses[0]
+                ttl = self.ttl
+            # A zero TTL means the answer must not be cached
+            if ttl > 0:
+                self._cache[domain] = (time.monotonic() + ttl, result)
+            logger.debug(f"Resolved {domain} to {result} (ttl {ttl}s)")
             return result
             
-        except socket.gaierror as e:
+        except aiodns.error.DNSError as e:
             logger.error(f"DNS resolution failed for {domain}: {e}")
             return None
         except Exception as e:
@@ -36,4 +84,4 @@ class DNSResolver:
         return {
             domain: result if not isinstance(result, Exception) else None
             for domain, result in zip(domains, results)
-        }
\ No newline at end of file
+        }
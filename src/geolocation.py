@@ -1,21 +1,59 @@
 import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 import aiohttp
 import logging
 
 logger = logging.getLogger(__name__)
 
+# This can be adjusted to include/exclude specific fields
+FIELDS = "status,message,country,countryCode,region,regionName,city,lat,lon,timezone,isp,org,as,query"
+
+# Maximum number of IPs accepted by a single ip-api.com batch request
+MAX_BATCH_SIZE = 100
+
+# The batch endpoint allows 15 requests per minute. This spacing is only used
+# when a response carries no X-Rl/X-Ttl quota headers
+BATCH_MIN_INTERVAL = 60 / 15
+
+# How many times a batch is retried after an HTTP 429
+BATCH_RETRIES = 2
+
+# Keep IN (...) lists below SQLite's bound-parameter limit
+SQLITE_CHUNK_SIZE = 500
+
 
 class GeolocationService:
     """Handles IP geolocation using ip-api.com service."""
     
-    def __init__(self, rate_limit_delay = 0.1):
+    def __init__(self, rate_limit_delay = 0.1, negative_ttl = 300,
+                 cache_path = 'geo_cache.db', cache_ttl = 30 * 24 * 3600):
         """
         Initialize geolocation service.
+        Successful lookups are persisted to the SQLite file at cache_path
+        (None disables it) and reused for cache_ttl seconds across runs.
         """
         self.base_url = "http://ip-api.com/json"
+        self.batch_url = "http://ip-api.com/batch"
         self.rate_limit_delay = rate_limit_delay
+        self.negative_ttl = negative_ttl
         self.session = None
         self._last_request_time = 0
+        self._rate_limit_lock = asyncio.Lock()
+        # Batch requests have their own, much smaller quota
+        self._batch_lock = asyncio.Lock()
+        self._batch_ready_at = 0
+        # IP -> normalized location data
+        self._cache: dict[str, dict] = {}
+        # IP -> timestamp of the last failed lookup
+        self._negative_cache: dict[str, float] = {}
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self._cache_db = None
+        # sqlite3 connections are not thread-safe, so use a single worker thread
+        self._cache_executor = None
     
     async def _ensure_session(self):
         """Ensure aiohttp session is created."""
@@ -24,36 +62,200 @@ class GeolocationService:
                 timeout=aiohttp.ClientTimeout(total=10)
             )
     
+    def _open_cache_db(self):
+        """Open the SQLite cache and create its table if missing."""
+        if self._cache_db is None:
+            db = sqlite3.connect(self.cache_path, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS geo_cache "
+                "(ip TEXT PRIMARY KEY, json TEXT NOT NULL, ts INTEGER NOT NULL)"
+            )
+            self._cache_db = db
+        return self._cache_db
+    
+    def _select_persisted(self, ips):
+        db = self._open_cache_db()
+        min_ts = int(time.time()) - self.cache_ttl
+        found = {}
+        for start in range(0, len(ips), SQLITE_CHUNK_SIZE):
+            chunk = ips[start:start + SQLITE_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = db.execute(
+                f"SELECT ip, json FROM geo_cache WHERE ts >= ? AND ip IN ({placeholders})",
+                (min_ts, *chunk)
+            )
+            for ip, data in rows:
+                found[ip] = json.loads(data)
+        return found
+    
+    def _insert_persisted(self, locations):
+        db = self._open_cache_db()
+        now = int(time.time())
+        # One transaction so the whole batch costs a single commit
+        with db:
+            db.execute("BEGIN")
+            db.executemany(
+                "INSERT OR REPLACE INTO geo_cache (ip, json, ts) VALUES (?, ?, ?)",
+                [(ip, json.dumps(location), now) for ip, location in locations.items()]
+            )
+    
+    async def _run_in_cache_thread(self, func, *args):
+        if self._cache_executor is None:
+            self._cache_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='geo_cache')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._cache_executor, func, *args)
+    
+    async def _load_persisted(self, ips):
+        """
+        Load non-expired locations for the given IPs from the SQLite cache
+        into the in-memory cache. Returns a dict of the IPs found.
+        """
+        if not self.cache_path or not ips:
+            return {}
+        try:
+            found = await self._run_in_cache_thread(self._select_persisted, ips)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to read geolocation cache {self.cache_path}: {e}")
+            return {}
+        self._cache.update(found)
+        return found
+    
+    async def _persist(self, locations):
+        """Write successful lookups to the SQLite cache."""
+        if not self.cache_path or not locations:
+            return
+        try:
+            await self._run_in_cache_thread(self._insert_persisted, locations)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to write geolocation cache {self.cache_path}: {e}")
+    
+    def _get_cached(self, ip):
+        """
+        Look up an IP in the cache. Returns (hit, location).
+        """
+        if ip in self._cache:
+            return True, self._cache[ip]
+        
+        failed_at = self._negative_cache.get(ip)
+        if failed_at is not None:
+            if time.monotonic() - failed_at < self.negative_ttl:
+                return True, None
+            del self._negative_cache[ip]
+        
+        return False, None
+    
+    def _store_result(self, ip, data):
+        """
+        Cache a raw API result for an IP and return the normalized location.
+        """
+        if data.get('status') == 'success':
+            logger.debug(f"Got location for {ip}: {data.get('city')}, {data.get('country')}")
+            location = self._normalize_location_data(data)
+            self._cache[ip] = location
+            return location
+        
+        logger.warning(f"API returned error for {ip}: {data.get('message')}")
+        # Remember failures (e.g. private/reserved ranges) for a while
+        self._negative_cache[ip] = self._last_request_time
+        return None
+    
+    async def _wait_for_rate_limit(self):
+        """Sleep until rate_limit_delay has passed since the last request."""
+        # Serialize concurrent callers so each one gets its own slot
+        async with self._rate_limit_lock:
+            now = time.monotonic()
+            wait = self.rate_limit_delay - (now - self._last_request_time)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                now += wait
+            self._last_request_time = now
+    
+    async def _wait_for_batch_quota(self):
+        """Sleep until the batch endpoint quota allows another request."""
+        wait = self._batch_ready_at - time.monotonic()
+        if wait > 0:
+            logger.info(f"Waiting {wait:.1f}s for the ip-api.com batch quota")
+            await asyncio.sleep(wait)
+    
+    def _update_batch_quota(self, response):
+        """
+        Track the batch quota from the X-Rl (requests left in the window)
+        and X-Ttl (seconds until the window resets) response headers.
+        """
+        now = time.monotonic()
+        try:
+            remaining = int(response.headers['X-Rl'])
+            reset_in = int(response.headers['X-Ttl'])
+        except (KeyError, ValueError):
+            if response.status == 429:
+                self._batch_ready_at = now + 60
+            else:
+                self._batch_ready_at = now + BATCH_MIN_INTERVAL
+            return
+        
+        if remaining <= 0 or response.status == 429:
+            self._batch_ready_at = now + reset_in
+    
+    async def _post_batch(self, chunk):
+        """
+        POST one chunk of IPs to the batch endpoint, retrying after HTTP 429.
+        Returns the list of raw results, or None on failure.
+        """
+        url = f"{self.batch_url}?fields={FIELDS}"
+        payload = [{'query': ip} for ip in chunk]
+        
+        for attempt in range(BATCH_RETRIES + 1):
+            await self._wait_for_batch_quota()
+            await self._wait_for_rate_limit()
+            
+            async with self.session.post(url, json=payload) as response:
+                self._last_request_time = time.monotonic()
+                self._update_batch_quota(response)
+                
+                if response.status == 200:
+                    return await response.json()
+                if response.status == 429:
+                    logger.warning(
+                        f"Rate limited by ip-api.com batch endpoint "
+                        f"(attempt {attempt + 1}/{BATCH_RETRIES + 1})"
+                    )
+                    continue
+                logger.error(f"HTTP error {response.status} for batch of {len(chunk)} IPs")
+                return None
+        
+        logger.error(f"Giving up on batch of {len(chunk)} IPs after repeated rate limiting")
+        return None
+    
     async def get_location(self, ip):
         """
         Get location information for an IP address.
         """
+        hit, location = self._get_cached(ip)
+        if hit:
+            return location
+        
+        persisted = await self._load_persisted([ip])
+        if ip in persisted:
+            return persisted[ip]
+        
         await self._ensure_session()
         
         try:
-            # Rate limiting
-            current_time = asyncio.get_event_loop().time()
-            time_since_last = current_time - self._last_request_time
-            if time_since_last < self.rate_limit_delay:
-                await asyncio.sleep(self.rate_limit_delay - time_since_last)
+            await self._wait_for_rate_limit()
             
-            # This can be adjusted to include/exclude specific fields
-
-            fields = "status,message,country,countryCode,region,regionName,city,lat,lon,timezone,isp,org,as,query"
-            url = f"{self.base_url}/{ip}?fields={fields}"
+            url = f"{self.base_url}/{ip}?fields={FIELDS}"
             
             async with self.session.get(url) as response:
-                self._last_request_time = asyncio.get_event_loop().time()
+                self._last_request_time = time.monotonic()
                 
                 if response.status == 200:
                     data = await response.json()
-                    
-                    if data.get('status') == 'success':
-                        logger.debug(f"Got location for {ip}: {data.get('city')}, {data.get('country')}")
-                        return self._normalize_location_data(data)
-                    else:
-                        logger.warning(f"API returned error for {ip}: {data.get('message')}")
-                        return None
+                    location = self._store_result(ip, data)
+                    if location:
+                        await self._persist({ip: location})
+                    return location
                 else:
                     logger.error(f"HTTP error {response.status} for IP {ip}")
                     return None
@@ -65,6 +267,55 @@ class GeolocationService:
             logger.error(f"Error getting location for {ip}: {e}")
             return None
     
+    async def get_locations_batch(self, ips):
+        """
+        Get location information for several IP addresses at once.
+        Cache misses are resolved through the ip-api.com batch endpoint,
+        up to MAX_BATCH_SIZE IPs per HTTP request.
+        Returns a dict mapping each IP to its location (or None).
+        """
+        locations = {}
+        misses = []
+        for ip in dict.fromkeys(ips):
+            hit, location = self._get_cached(ip)
+            if hit:
+                locations[ip] = location
+            else:
+                locations[ip] = None
+                misses.append(ip)
+        
+        if misses:
+            persisted = await self._load_persisted(misses)
+            locations.update(persisted)
+            misses = [ip for ip in misses if ip not in persisted]
+        
+        if not misses:
+            return locations
+        
+        await self._ensure_session()
+        
+        fetched = {}
+        # One batch caller at a time, so quota tracking stays consistent
+        async with self._batch_lock:
+            for start in range(0, len(misses), MAX_BATCH_SIZE):
+                chunk = misses[start:start + MAX_BATCH_SIZE]
+                try:
+                    results = await self._post_batch(chunk)
+                except asyncio.TimeoutError:
+                    logger.error(f"Timeout getting locations for batch of {len(chunk)} IPs")
+                    continue
+                except Exception as e:
+                    logger.error(f"Error getting locations for batch of {len(chunk)} IPs: {e}")
+                    continue
+                
+                for ip, data in zip(chunk, results or []):
+                    locations[ip] = self._store_result(ip, data)
+                    if locations[ip]:
+                        fetched[ip] = locations[ip]
+        
+        await self._persist(fetched)
+        return locations
+    
     def _normalize_location_data(self, data):
         """
         Normalize and clean location data from API response.
@@ -86,7 +337,13 @@ class GeolocationService:
         }
     
     async def close(self):
-        """Close the aiohttp session."""
+        """Close the aiohttp session and the SQLite cache."""
         if self.session:
             await self.session.close()
-            self.session = None
\ No newline at end of file
+            self.session = None
+        if self._cache_executor is not None:
+            if self._cache_db is not None:
+                await self._run_in_cache_thread(self._cache_db.close)
+                self._cache_db = None
+            self._cache_executor.shutdown()
+            self._cache_executor = None
\ No newline at end of file
@@ -1,9 +1,58 @@
+import asyncio
 import logging
+import os
+from functools import singledispatch
+import orjson
 from neo4j import AsyncGraphDatabase
-from neo4j.exceptions import ServiceUnavailable, AuthError
+from neo4j.exceptions import ServiceUnavailable, AuthError, Neo4jError
+from neo4j.time import Date, DateTime, Duration, Time
 
 logger = logging.getLogger(__name__)
 
+# Unique key an imported node is merged on, per label (see _ensure_constraints)
+IMPORT_MERGE_KEYS = {'IP': 'address', 'Domain': 'name'}
+
+# Property that tells parallel relationships of a type apart, per type
+# (ROUTES_TO edges are keyed on hop_number by _create_network_path_tx)
+IMPORT_REL_MERGE_KEYS = {'ROUTES_TO': 'hop_number'}
+
+
+@singledispatch
+def _to_json_value(obj):
+    """
+    Convert a property value to something JSON-serializable.
+    Anything without a registered type (e.g. Neo4j spatial values) becomes a string.
+    """
+    return str(obj)
+
+
+@_to_json_value.register(dict)
+def _(obj):
+    return {k: _to_json_value(v) for k, v in obj.items()}
+
+
+@_to_json_value.register(list)
+def _(obj):
+    return [_to_json_value(v) for v in obj]
+
+
+@_to_json_value.register(str)
+@_to_json_value.register(int)
+@_to_json_value.register(float)
+@_to_json_value.register(bool)
+@_to_json_value.register(type(None))
+def _(obj):
+    return obj
+
+
+# Neo4j temporal values are written in their ISO form
+@_to_json_value.register(Date)
+@_to_json_value.register(DateTime)
+@_to_json_value.register(Time)
+@_to_json_value.register(Duration)
+def _(obj):
+    return str(obj)
+
 
 class GraphDatabase:
     
@@ -12,7 +61,12 @@ class GraphDatabase:
         self.username = config.get('username', 'neo4j')
         self.password = config.get('password', 'neo4j')
         self.database = config.get('database', 'neo4j')
+        self.import_batch_size = config.get('import_batch_size', 1000)
         self.driver = None
+        # A session can only run one transaction at a time. The analysis pipeline
+        # writes from a single worker, so this only guards other callers that
+        # share a session between concurrent tasks
+        self._shared_session_lock = asyncio.Lock()
     
     async def connect(self):
         try:
@@ -24,6 +78,7 @@ class GraphDatabase:
             # Test the connection
             async with self.driver.session(database=self.database) as session:
                 await session.run("RETURN 1")
+                await self._ensure_constraints(session)
             
             logger.info("Connected to Neo4j database")
             
@@ -31,24 +86,58 @@ class GraphDatabase:
             logger.error(f"Failed to connect to Neo4j: {e}")
             raise
     
+    async def _ensure_constraints(self, session):
+        """
+        Create unique constraints (and their backing indexes) used by the
+        MERGE/MATCH lookups on IP addresses and domain names.
+        """
+        for statement in (
+            "CREATE CONSTRAINT ip_address IF NOT EXISTS FOR (ip:IP) REQUIRE ip.address IS UNIQUE",
+            "CREATE CONSTRAINT domain_name IF NOT EXISTS FOR (d:Domain) REQUIRE d.name IS UNIQUE",
+        ):
+            try:
+                result = await session.run(statement)
+                await result.consume()
+            except Neo4jError as e:
+                # e.g. existing duplicate nodes; lookups still work, just slower
+                logger.warning(f"Could not create constraint: {e}")
+    
     async def ensure_connected(self):
         if self.driver is None:
             await self.connect()
     
-    async def store_network_path(self, domain, target_ip, hops):
+    async def session(self):
+        """
+        Open a session that can be reused for several store_network_path calls.
+        """
+        await self.ensure_connected()
+        return self.driver.session(database=self.database)
+    
+    async def store_network_path(self, domain, target_ip, hops, session=None):
+        """
+        Store a network path. If session is given (see session()), it is reused
+        instead of opening a new one; concurrent callers take turns on it.
+        """
         await self.ensure_connected()
         
-        async with self.driver.session(database=self.database) as session:
-            try:
-                await session.execute_write(
-                    self._create_network_path_tx,
-                    domain, target_ip, hops
-                )
-                logger.info(f"Stored network path for {domain} with {len(hops)} hops")
-                
-            except Exception as e:
-                logger.error(f"Failed to store network path for {domain}: {e}")
-                raise
+        if session is None:
+            async with self.driver.session(database=self.database) as own_session:
+                await self._write_network_path(own_session, domain, target_ip, hops)
+        else:
+            async with self._shared_session_lock:
+                await self._write_network_path(session, domain, target_ip, hops)
+    
+    async def _write_network_path(self, session, domain, target_ip, hops):
+        try:
+            await session.execute_write(
+                self._create_network_path_tx,
+                domain, target_ip, hops
+            )
+            logger.info(f"Stored network path for {domain} with {len(hops)} hops")
+            
+        except Exception as e:
+            logger.error(f"Failed to store network path for {domain}: {e}")
+            raise
     
     @staticmethod
     async def _create_network_path_tx(tx, domain, target_ip, hops):
@@ -68,62 +157,72 @@ class GraphDatabase:
             hop_count=len(hops)
         )
         
+        rows = []
         for i, hop_data in enumerate(hops):
             # Ensure hop_data is a dict
             if not isinstance(hop_data, dict):
                 logger.warning(f"Invalid hop_data at index {i}: {hop_data}")
                 continue
-            ip = hop_data.get('ip')
             geo_data = hop_data.get('geo_data') or {}
             if not isinstance(geo_data, dict):
                 geo_data = {}
-            
-            # Create or update IP node with geolocation data
+            prev_hop = hops[i-1] if i > 0 else None
+            rows.append({
+                'ip': hop_data.get('ip'),
+                'latitude': geo_data.get('latitude', None),
+                'longitude': geo_data.get('longitude', None),
+                'city': geo_data.get('city', 'Unknown'),
+                'hop_number': i + 1,
+                'prev_ip': prev_hop.get('ip') if isinstance(prev_hop, dict) else None
+            })
+        
+        if not rows:
+            return
+        
+        # Create or update all IP nodes with geolocation data,
+        # once per distinct IP even if it appears at several hops
+        ip_rows = list({row['ip']: row for row in rows}.values())
+        await tx.run(
+            """
+            UNWIND $rows AS row
+            MERGE (ip:IP {address: row.ip})
+            SET ip.latitude = row.latitude,
+                ip.longitude = row.longitude,
+                ip.city = row.city,
+                ip.last_seen = datetime()
+            """,
+            rows=ip_rows
+        )
+        
+        # First hop - connect from domain
+        if rows[0]['hop_number'] == 1:
             await tx.run(
                 """
-                MERGE (ip:IP {address: $ip})
-                SET ip.latitude = $latitude,
-                    ip.longitude = $longitude,
-                    ip.city = $city,
-                    ip.last_seen = datetime()
+                MATCH (d:Domain {name: $domain})
+                MATCH (ip:IP {address: $ip})
+                MERGE (d)-[r:ROUTES_TO {hop_number: $hop_number}]->(ip)
+                SET r.timestamp = datetime(),
+                    r.domains = CASE WHEN $domain IN coalesce(r.domains, []) THEN r.domains ELSE coalesce(r.domains, []) + $domain END
                 """,
-                ip=ip,
-                latitude=geo_data.get('latitude', None),
-                longitude=geo_data.get('longitude', None),
-                city=geo_data.get('city', 'Unknown'),
-                domain=domain            
-                )
-            
-            # Create hop relationship
-            if i == 0:
-                # First hop - connect from domain
-                await tx.run(
-                    """
-                    MATCH (d:Domain {name: $domain})
-                    MATCH (ip:IP {address: $ip})
-                    MERGE (d)-[r:ROUTES_TO {hop_number: $hop_number}]->(ip)
-                    SET r.timestamp = datetime(),
-                        r.domains = CASE WHEN $domain IN coalesce(r.domains, []) THEN r.domains ELSE coalesce(r.domains, []) + $domain END
-                    """,
-                    domain=domain,
-                    ip=ip,
-                    hop_number=i + 1
-                )
-            else:
-                # Subsequent hops - connect from previous IP
-                await tx.run(
-                    """
-                    MATCH (prev:IP {address: $prev_ip})
-                    MATCH (curr:IP {address: $curr_ip})
-                    MERGE (prev)-[r:ROUTES_TO {hop_number: $hop_number}]->(curr)
-                    SET r.timestamp = datetime(),
-                        r.domains = CASE WHEN $domain IN coalesce(r.domains, []) THEN r.domains ELSE coalesce(r.domains, []) + $domain END
-                    """,
-                    prev_ip=hops[i-1]['ip'],
-                    curr_ip=ip,
-                    hop_number=i + 1,
-                    domain=domain
-                )
+                domain=domain,
+                ip=rows[0]['ip'],
+                hop_number=1
+            )
+        
+        # Subsequent hops - connect from previous IP
+        await tx.run(
+            """
+            UNWIND $rows AS row
+            WITH row WHERE row.prev_ip IS NOT NULL
+            MATCH (prev:IP {address: row.prev_ip})
+            MATCH (curr:IP {address: row.ip})
+            MERGE (prev)-[r:ROUTES_TO {hop_number: row.hop_number}]->(curr)
+            SET r.timestamp = datetime(),
+                r.domains = CASE WHEN $domain IN coalesce(r.domains, []) THEN r.domains ELSE coalesce(r.domains, []) + $domain END
+            """,
+            rows=rows,
+            domain=domain
+        )
             
     
     async def get_network_paths(self):
@@ -187,53 +286,75 @@ class GraphDatabase:
         """
         Recursively convert non-JSON-serializable values (e.g., DateTime) to strings.
         """
-        if isinstance(obj, dict):
-            return {k: self._make_json_serializable(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [self._make_json_serializable(v) for v in obj]
-        elif hasattr(obj, 'iso_format'):
-            # Neo4j DateTime objects
-            return str(obj)
-        elif hasattr(obj, '__str__') and not isinstance(obj, (str, int, float, bool, type(None))):
-            return str(obj)
-        else:
-            return obj
+        return _to_json_value(obj)
+
+    async def _write_streamed(self, session, query, format_record, f):
+        """
+        Write the results of a query into a JSON array in a binary file.
+        The driver fetches records in fetch_size batches, so each one is
+        written as it arrives instead of collecting them all first.
+        """
+        result = await session.run(query)
+        first = True
+        async for record in result:
+            if not first:
+                f.write(b',')
+            f.write(orjson.dumps(format_record(record)))
+            first = False
+    
+    def _format_node_record(self, record):
+        node_obj = record['node']
+        return {
+            'id': record['id'],
+            'labels': record['labels'],
+            'properties': self._make_json_serializable(dict(node_obj._properties))
+        }
+    
+    def _format_rel_record(self, record):
+        rel_obj = record['rel']
+        return {
+            'id': record['id'],
+            'type': record['type'],
+            'properties': self._make_json_serializable(dict(rel_obj._properties)),
+            'start': record['start'],
+            'end': record['end']
+        }
 
     async def export_graph_to_json(self, file_path: str):
         """
         Export the entire graph database (all nodes and relationships) to a local JSON file.
+        Records are written as they are streamed from the database, into a temporary
+        file that replaces file_path only once the export has completed.
         """
-        import json
         await self.ensure_connected()
-        async with self.driver.session(database=self.database) as session:
-            # Export all nodes
-            nodes_result = await session.run("MATCH (n) RETURN id(n) as id, labels(n) as labels, n as node")
-            nodes = []
-            async for record in nodes_result:
-                node_obj = record['node']
-                props = self._make_json_serializable(dict(node_obj._properties))
-                nodes.append({
-                    'id': record['id'],
-                    'labels': record['labels'],
-                    'properties': props
-                })
-            # Export all relationships
-            rels_result = await session.run("MATCH ()-[r]->() RETURN id(r) as id, type(r) as type, r as rel, id(startNode(r)) as start, id(endNode(r)) as end")
-            relationships = []
-            async for record in rels_result:
-                rel_obj = record['rel']
-                props = self._make_json_serializable(dict(rel_obj._properties))
-                relationships.append({
-                    'id': record['id'],
-                    'type': record['type'],
-                    'properties': props,
-                    'start': record['start'],
-                    'end': record['end']
-                })
-            # Write to file
-            with open(file_path, 'w') as f:
-                json.dump({'nodes': nodes, 'relationships': relationships}, f, indent=2)
-            logger.info(f"Exported graph database to {file_path}")
+        tmp_path = f"{file_path}.tmp"
+        try:
+            async with self.driver.session(database=self.database) as session:
+                with open(tmp_path, 'wb') as f:
+                    # Export all nodes
+                    f.write(b'{"nodes":[')
+                    await self._write_streamed(
+                        session,
+                        "MATCH (n) RETURN id(n) as id, labels(n) as labels, n as node",
+                        self._format_node_record,
+                        f
+                    )
+                    # Export all relationships
+                    f.write(b'],"relationships":[')
+                    await self._write_streamed(
+                        session,
+                        "MATCH ()-[r]->() RETURN id(r) as id, type(r) as type, r as rel, id(startNode(r)) as start, id(endNode(r)) as end",
+                        self._format_rel_record,
+                        f
+                    )
+                    f.write(b']}')
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            # Leave any previous export untouched
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logger.info(f"Exported graph database to {file_path}")
     
     async def import_graph_from_json(self, file_path: str):
         """
@@ -241,33 +362,90 @@ class GraphDatabase:
         Args:
             file_path: Path to the input JSON file
         """
-        import json
         await self.ensure_connected()
-        with open(file_path, 'r') as f:
-            data = json.load(f)
+        with open(file_path, 'rb') as f:
+            data = orjson.loads(f.read())
         nodes = data.get('nodes', [])
         relationships = data.get('relationships', [])
+        # Group nodes by label combination (and merge key) and relationships by type,
+        # since labels and types can't be passed as parameters
+        nodes_by_labels = {}
+        for node in nodes:
+            props = node['properties']
+            key_label = next(
+                (label for label in sorted(node['labels'])
+                 if props.get(IMPORT_MERGE_KEYS.get(label)) is not None),
+                None
+            )
+            key = IMPORT_MERGE_KEYS.get(key_label)
+            labels = "".join(f":`{label}`" for label in sorted(node['labels']))
+            nodes_by_labels.setdefault((labels, key_label, key), []).append(
+                {'id': node['id'], 'props': props}
+            )
+        rels_by_type = {}
+        for rel in relationships:
+            key = IMPORT_REL_MERGE_KEYS.get(rel['type'])
+            if rel['properties'].get(key) is None:
+                key = None
+            rels_by_type.setdefault((rel['type'], key), []).append(
+                {'start': rel['start'], 'end': rel['end'], 'props': rel['properties']}
+            )
+        
+        batch_size = self.import_batch_size
         async with self.driver.session(database=self.database) as session:
-            # Create nodes
-            for node in nodes:
-                labels = ":".join(node['labels'])
-                props = node['properties']
-                props['import_id'] = node['id']  # Temporary property for matching
-                await session.run(
-                    f"MERGE (n:{labels} {{import_id: $import_id}}) SET n += $props",
-                    import_id=node['id'], props=props
-                )
-            # Create relationships
-            for rel in relationships:
-                await session.run(
+            # Imported nodes carry a temporary label and import_id so relationships
+            # can find their endpoints through an index
+            await self._run_consumed(
+                session,
+                "CREATE INDEX import_node_import_id IF NOT EXISTS "
+                "FOR (n:ImportNode) ON (n.import_id)"
+            )
+            try:
+                await self._run_consumed(session, "CALL db.awaitIndexes()")
+                
+                # Create nodes. IP and Domain nodes merge on their unique key so
+                # re-importing into a populated database updates existing nodes
+                for (labels, key_label, key), rows in nodes_by_labels.items():
+                    if key is None:
+                        query = (
+                            "UNWIND $batch AS r "
+                            f"MERGE (n{labels}:ImportNode {{import_id: r.id}}) SET n += r.props"
+                        )
+                    else:
+                        query = (
+                            "UNWIND $batch AS r "
+                            f"MERGE (n:`{key_label}` {{{key}: r.props.{key}}}) "
+                            f"SET n{labels}:ImportNode, n += r.props, n.import_id = r.id"
+                        )
+                    for start in range(0, len(rows), batch_size):
+                        await self._run_consumed(session, query, batch=rows[start:start + batch_size])
+                # Create relationships. Keyed types merge on their key so parallel
+                # edges (e.g. ROUTES_TO at different hop numbers) stay distinct
+                for (rel_type, key), rows in rels_by_type.items():
+                    rel_key = "" if key is None else f" {{{key}: r.props.{key}}}"
+                    query = """
+                        UNWIND $batch AS r
+                        MATCH (a:ImportNode {import_id: r.start})
+                        MATCH (b:ImportNode {import_id: r.end})
+                        MERGE (a)-[x:`%s`%s]->(b)
+                        SET x += r.props
+                        """ % (rel_type, rel_key)
+                    for start in range(0, len(rows), batch_size):
+                        await self._run_consumed(session, query, batch=rows[start:start + batch_size])
+            finally:
+                # Remove temporary import label, property and index, even after a failure
+                await self._run_consumed(
+                    session,
+                    """
+                    MATCH (n:ImportNode)
+                    CALL { WITH n REMOVE n.import_id, n:ImportNode } IN TRANSACTIONS OF 10000 ROWS
                     """
-                    MATCH (a {import_id: $start})
-                    MATCH (b {import_id: $end})
-                    MERGE (a)-[r:%s]->(b)
-                    SET r += $props
-                    """ % rel['type'],
-                    start=rel['start'], end=rel['end'], props=rel['properties']
                 )
-            # Remove temporary import_id property
-            await session.run("MATCH (n) REMOVE n.import_id")
-        logger.info(f"Imported graph database from {file_path}")
\ No newline at end of file
+                await self._run_consumed(session, "DROP INDEX import_node_import_id IF EXISTS")
+        logger.info(f"Imported graph database from {file_path}")
+    
+    @staticmethod
+    async def _run_consumed(session, query, **params):
+        """Run an auto-commit query and consume it, so errors surface here."""
+        result = await session.run(query, **params)
+        await result.consume()
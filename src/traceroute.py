@@ -3,25 +3,153 @@ Traceroute module for network path analysis.
 """
 
 import asyncio
-import subprocess
+import ipaddress
+import socket
+import struct
 import re
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Dotted-quad IPv4 address with every octet in 0-255
+_IP_RE = re.compile(
+    r'\b(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)'
+    r'(?:\.(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}\b'
+)
+
+# Header line printed by traceroute/tracert
+_BANNER_RE = re.compile(r'traceroute|tracing route', re.IGNORECASE)
+
+# UDP probes go to BASE_PORT + ttl so replies can be matched to their TTL
+BASE_PORT = 33434
+
+ICMP_TIME_EXCEEDED = 11
+ICMP_DEST_UNREACHABLE = 3
+
 
 class TracerouteRunner:
     """Handles traceroute execution and parsing."""
     
-    def __init__(self, max_hops = 38, timeout = 5):
+    def __init__(self, max_hops = 38, timeout = 5, use_probes = True, max_concurrent = 8):
         self.max_hops = max_hops
         self.timeout = timeout
+        # Cap on traceroutes in flight, to stay clear of ICMP rate limits
+        self._sem = asyncio.Semaphore(max_concurrent)
+        # Send all TTL probes at once over raw sockets (needs CAP_NET_RAW),
+        # falling back to the traceroute binary when not permitted
+        self.use_probes = use_probes
     
     async def run_traceroute(self, target_ip):
         """
         Run traceroute to target IP and return list of hop IPs.
     
         """
+        async with self._sem:
+            if self.use_probes:
+                try:
+                    return await self._run_probes(target_ip)
+                except PermissionError:
+                    logger.warning("Raw sockets not permitted, falling back to the traceroute binary")
+                    self.use_probes = False
+                except Exception as e:
+                    logger.error(f"Traceroute to {target_ip} failed: {e}")
+                    return []
+            
+            return await self._run_traceroute_command(target_ip)
+    
+    async def _run_probes(self, target_ip):
+        """
+        Fire one UDP probe per TTL in a single burst and collect the ICMP
+        replies, so the whole path takes about one timeout instead of one per hop.
+        """
+        loop = asyncio.get_running_loop()
+        recv_sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            recv_sock.setblocking(False)
+            send_sock.setblocking(False)
+            send_sock.bind(('', 0))
+            src_port = send_sock.getsockname()[1]
+            
+            for ttl in range(1, self.max_hops + 1):
+                send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+                send_sock.sendto(b'', (target_ip, BASE_PORT + ttl))
+            
+            replies = {}
+            dest_ttl = None
+            deadline = loop.time() + self.timeout
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    packet, (addr, _) = await asyncio.wait_for(
+                        loop.sock_recvfrom(recv_sock, 1500),
+                        timeout=remaining
+                    )
+                except asyncio.TimeoutError:
+                    break
+                
+                matched = self._match_probe_reply(packet, target_ip, src_port)
+                if matched is None:
+                    continue
+                ttl, icmp_type = matched
+                replies.setdefault(ttl, addr)
+                if icmp_type == ICMP_DEST_UNREACHABLE and addr == target_ip:
+                    dest_ttl = ttl if dest_ttl is None else min(dest_ttl, ttl)
+                
+                # Stop early once every hop up to the target has answered
+                if dest_ttl is not None and all(t in replies for t in range(1, dest_ttl + 1)):
+                    break
+        finally:
+            send_sock.close()
+            recv_sock.close()
+        
+        last_ttl = dest_ttl or self.max_hops
+        hops = [
+            replies[ttl] for ttl in sorted(replies)
+            if ttl <= last_ttl and self._is_valid_hop_ip(replies[ttl])
+        ]
+        logger.info(f"Collected {len(hops)} valid hops from probes to {target_ip}")
+        return hops
+    
+    def _match_probe_reply(self, packet, target_ip, src_port):
+        """
+        Match an ICMP reply to one of our probes.
+        Returns (ttl, icmp_type) or None if the packet is not ours.
+        """
+        if len(packet) < 20:
+            return None
+        ihl = (packet[0] & 0x0F) * 4
+        if len(packet) < ihl + 8:
+            return None
+        icmp_type = packet[ihl]
+        if icmp_type not in (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACHABLE):
+            return None
+        
+        # The ICMP payload echoes the original IP header and 8 bytes of UDP header
+        inner = packet[ihl + 8:]
+        if len(inner) < 20:
+            return None
+        inner_ihl = (inner[0] & 0x0F) * 4
+        if inner[9] != socket.IPPROTO_UDP or len(inner) < inner_ihl + 4:
+            return None
+        if socket.inet_ntoa(inner[16:20]) != target_ip:
+            return None
+        sport, dport = struct.unpack('!HH', inner[inner_ihl:inner_ihl + 4])
+        if sport != src_port:
+            return None
+        
+        ttl = dport - BASE_PORT
+        if not 1 <= ttl <= self.max_hops:
+            return None
+        return ttl, icmp_type
+    
+    async def _run_traceroute_command(self, target_ip):
+        """
+        Run the system traceroute binary and parse its output.
+        """
+        process = None
         try:
             cmd = self._build_traceroute_command(target_ip)
             
@@ -32,9 +160,11 @@ class TracerouteRunner:
                 stderr=asyncio.subprocess.PIPE
             )
             
+            # Probes run in parallel, so the whole trace takes about one
+            # probe timeout per round rather than one per hop
             stdout, stderr = await asyncio.wait_for(
                 process.communicate(), 
-                timeout=120  # 60 second timeout for entire traceroute
+                timeout=self.timeout * 2 + 5
             )
             
             if process.returncode != 0:
@@ -44,6 +174,10 @@ class TracerouteRunner:
             
         except asyncio.TimeoutError:
             logger.error(f"Traceroute to {target_ip} timed out")
+            # Don't leave the traceroute process running
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.wait()
             return []
         except Exception as e:
             logger.error(f"Traceroute to {target_ip} failed: {e}")
@@ -53,8 +187,10 @@ class TracerouteRunner:
             return [
                 'traceroute',
                 '-m', str(self.max_hops),
-                # '-w', str(self.timeout),
-                #'-n',  # Don't resolve hostnames
+                '-N', '32',  # Send up to 32 probes in parallel
+                '-q', '1',  # One probe per hop
+                '-w', str(self.timeout),
+                '-n',  # Don't resolve hostnames
                 target_ip
             ]
     
@@ -64,22 +200,19 @@ class TracerouteRunner:
         """
         hops = []
         
-        # IP address regex pattern
-        ip_pattern = r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b'
-        
         for line in output.split('\n'):
             line = line.strip()
             if not line:
                 continue
             
-            if 'traceroute' in line.lower() or 'tracing route' in line.lower():
+            if _BANNER_RE.search(line):
                 continue
             
-            # Find IP addresses in the line
-            ip_matches = re.findall(ip_pattern, line)
+            # Only the first IP address in the line is the hop
+            match = _IP_RE.search(line)
             
-            if ip_matches:
-                hop_ip = ip_matches[0]
+            if match:
+                hop_ip = match.group(0)
                 
                 if self._is_valid_hop_ip(hop_ip):
                     hops.append(hop_ip)
@@ -91,18 +224,17 @@ class TracerouteRunner:
     def _is_valid_hop_ip(self, ip: str):
         """
         Check if IP address is valid for our analysis.
-        TODO: This might be improved.
+        Private ranges are kept, they are real hops on the local/ISP side.
         """
-        if ip.startswith('127.') or ip.startswith('255.'):
-            return False
-        
-        if ip == '0.0.0.0':
+        try:
+            addr = ipaddress.IPv4Address(ip)
+        except ValueError:
             return False
         
-        # if (ip.startswith('10.') or 
-        #     ip.startswith('192.168.') or 
-        #     ip.startswith('172.16.') or
-        #     ip.startswith('169.254.')):
-        #     return False
-        
-        return True
\ No newline at end of file
+        return not (
+            addr.is_loopback or
+            addr.is_unspecified or
+            addr.is_link_local or
+            addr.is_multicast or
+            addr.is_reserved
+        )
\ No newline at end of file